@@ -0,0 +1,253 @@
+"""
+Tests for the incoming webhook listeners of :mod:`xmppwb.bridge`.
+
+The bridges are created from config dicts and run on a real event loop with
+real sockets. Only the XMPP connection is replaced.
+"""
+import asyncio
+import json
+import os
+import socket
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+import aiohttp
+
+from xmppwb.bridge import (XMPPWebhookBridge, WebhookListener,
+                           SingleBridge, InvalidConfigError)
+
+
+def make_cfg(listeners, bridges):
+    return {
+        'xmpp': {
+            'jid': 'bot@example.com',
+            'password': 'secret',
+        },
+        'incoming_webhook_listener': listeners,
+        'bridges': bridges,
+    }
+
+
+def make_bridge_cfg(jid, token, path=None):
+    incoming_webhook = {'token': token}
+    if path is not None:
+        incoming_webhook['path'] = path
+    return {
+        'xmpp_endpoints': [{'normal': jid}],
+        'incoming_webhooks': [incoming_webhook],
+    }
+
+
+class BridgeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.tmpdir.name, 'xmppwb.sock')
+
+        patcher = mock.patch.multiple('xmppwb.bridge.XMPPBridgeBot',
+                                      connect=mock.DEFAULT,
+                                      disconnect=mock.DEFAULT,
+                                      send_message=mock.DEFAULT)
+        self.xmpp = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.bridge = None
+
+    def tearDown(self):
+        if self.bridge is not None:
+            self.bridge.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.tmpdir.cleanup()
+
+    def create_bridge(self, cfg):
+        self.bridge = XMPPWebhookBridge(cfg, self.loop)
+        return self.bridge
+
+    def get_port(self, listener):
+        return listener.http_server.sockets[0].getsockname()[1]
+
+    def post(self, url, payload):
+        async def post():
+            async with aiohttp.ClientSession(loop=self.loop) as session:
+                async with session.post(
+                        url,
+                        data=json.dumps(payload),
+                        headers={'content-type': 'application/json'}) as r:
+                    return r.status
+        return self.loop.run_until_complete(post())
+
+    def sent_to(self):
+        """Returns the JIDs that XMPP messages were sent to."""
+        return [call[1]['mto']
+                for call in self.xmpp['send_message'].call_args_list]
+
+
+class ListenerConfigTest(unittest.TestCase):
+    def test_tcp_listener(self):
+        listener = WebhookListener({'bind_address': '127.0.0.1',
+                                    'port': 5000})
+        self.assertEqual(str(listener), 'http://127.0.0.1:5000/')
+        self.assertIsNone(listener.max_connections)
+
+    def test_unix_socket_listener(self):
+        listener = WebhookListener({'socket_path': '/run/xmppwb.sock',
+                                    'mode': '0660'})
+        self.assertEqual(str(listener), 'unix:/run/xmppwb.sock')
+        self.assertEqual(listener.socket_mode, 0o660)
+
+    def test_missing_address(self):
+        with self.assertRaises(InvalidConfigError):
+            WebhookListener({'bind_address': '127.0.0.1'})
+        with self.assertRaises(InvalidConfigError):
+            # The URL path of incoming webhooks is not a listener option.
+            WebhookListener({'path': '/run/xmppwb.sock'})
+
+    def test_socket_mode(self):
+        for mode, expected in (('660', 0o660), ('0777', 0o777), (0o600, 0o600),
+                               (0, 0)):
+            listener = WebhookListener({'socket_path': '/run/xmppwb.sock',
+                                        'mode': mode})
+            self.assertEqual(listener.socket_mode, expected)
+
+    def test_invalid_socket_mode(self):
+        # 660 without quotes is decimal 660, i.e. 0o1224.
+        for mode in ('rw', '1777', 660, -1, True, ['0660'], None):
+            with self.assertRaises(InvalidConfigError):
+                WebhookListener({'socket_path': '/run/xmppwb.sock',
+                                 'mode': mode})
+
+    def test_invalid_incoming_webhook_path(self):
+        main_bridge = mock.Mock(mucs=dict())
+        for path in ('relative', 5, '/{name}'):
+            with self.assertRaises(InvalidConfigError):
+                SingleBridge(make_bridge_cfg('a@example.com', 'token', path),
+                             main_bridge)
+
+
+class ListenerTest(BridgeTestCase):
+    def test_listener_list_entries_must_be_mappings(self):
+        cfg = make_cfg(['127.0.0.1'],
+                       [make_bridge_cfg('a@example.com', 'token')])
+        with self.assertRaises(InvalidConfigError):
+            self.create_bridge(cfg)
+
+    def test_single_listener_without_list(self):
+        cfg = make_cfg({'bind_address': '127.0.0.1', 'port': 0},
+                       [make_bridge_cfg('a@example.com', 'token')])
+        bridge = self.create_bridge(cfg)
+        self.assertEqual(len(bridge.http_listeners), 1)
+
+    def test_routing_by_path(self):
+        cfg = make_cfg(
+            [{'bind_address': '127.0.0.1', 'port': 0},
+             {'socket_path': self.socket_path}],
+            [make_bridge_cfg('root@example.com', 'token'),
+             make_bridge_cfg('a@example.com', 'token', '/a'),
+             make_bridge_cfg('b@example.com', 'token', '/b')])
+        bridge = self.create_bridge(cfg)
+        url = 'http://127.0.0.1:{}'.format(
+            self.get_port(bridge.http_listeners[0]))
+        payload = {'token': 'token', 'user_name': 'bob', 'text': 'hi'}
+
+        self.assertEqual(self.post(url + '/a', payload), 200)
+        self.assertEqual(self.sent_to(), ['a@example.com'])
+
+        self.xmpp['send_message'].reset_mock()
+        self.assertEqual(self.post(url + '/', payload), 200)
+        self.assertEqual(self.sent_to(), ['root@example.com'])
+
+        self.xmpp['send_message'].reset_mock()
+        self.assertEqual(self.post(url + '/c', payload), 404)
+        self.assertEqual(self.sent_to(), [])
+
+    def test_routing_over_unix_socket(self):
+        cfg = make_cfg([{'socket_path': self.socket_path, 'mode': '0600'}],
+                       [make_bridge_cfg('b@example.com', 'token', '/b')])
+        self.create_bridge(cfg)
+        mode = os.stat(self.socket_path).st_mode
+        self.assertTrue(stat.S_ISSOCK(mode))
+        self.assertEqual(stat.S_IMODE(mode), 0o600)
+
+        async def post():
+            reader, writer = await asyncio.open_unix_connection(
+                self.socket_path, loop=self.loop)
+            body = json.dumps({'token': 'token', 'user_name': 'bob',
+                               'text': 'hi'}).encode()
+            writer.write(b'POST /b HTTP/1.1\r\n'
+                         b'Host: localhost\r\n'
+                         b'Content-Type: application/json\r\n'
+                         b'Connection: close\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() +
+                         b'\r\n\r\n' + body)
+            response = await reader.read()
+            writer.close()
+            return response
+        response = self.loop.run_until_complete(post())
+        self.assertTrue(response.startswith(b'HTTP/1.1 200'))
+        self.assertEqual(self.sent_to(), ['b@example.com'])
+
+    def test_bind_failure_stops_started_listeners(self):
+        blocker = socket.socket()
+        blocker.bind(('127.0.0.1', 0))
+        blocker.listen(1)
+        self.addCleanup(blocker.close)
+        cfg = make_cfg(
+            [{'socket_path': self.socket_path},
+             {'bind_address': '127.0.0.1',
+              'port': blocker.getsockname()[1]}],
+            [make_bridge_cfg('a@example.com', 'token')])
+        with self.assertRaises(InvalidConfigError):
+            self.create_bridge(cfg)
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_close_removes_unix_socket(self):
+        cfg = make_cfg([{'socket_path': self.socket_path}],
+                       [make_bridge_cfg('a@example.com', 'token')])
+        bridge = self.create_bridge(cfg)
+        self.assertTrue(os.path.exists(self.socket_path))
+        bridge.close()
+        self.bridge = None
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_max_connections(self):
+        cfg = make_cfg(
+            [{'bind_address': '127.0.0.1', 'port': 0, 'max_connections': 2}],
+            [make_bridge_cfg('a@example.com', 'token')])
+        bridge = self.create_bridge(cfg)
+        listener = bridge.http_listeners[0]
+        port = self.get_port(listener)
+
+        async def connect():
+            return await asyncio.open_connection('127.0.0.1', port,
+                                                 loop=self.loop)
+
+        async def is_closed(reader):
+            try:
+                return await asyncio.wait_for(reader.read(), 0.5,
+                                              loop=self.loop) == b''
+            except asyncio.TimeoutError:
+                return False
+
+        # Open all connections at once, so that they are accepted together.
+        connections = self.loop.run_until_complete(asyncio.gather(
+            *[connect() for i in range(20)], loop=self.loop))
+        closed = self.loop.run_until_complete(asyncio.gather(
+            *[is_closed(reader) for reader, writer in connections],
+            loop=self.loop))
+        self.assertEqual(closed.count(False), 2)
+        self.assertEqual(listener.open_connections, 2)
+        self.assertEqual(len(listener.http_handler.connections), 2)
+
+        # Closed connections free their slot again.
+        for reader, writer in connections:
+            writer.close()
+        self.loop.run_until_complete(asyncio.sleep(0.1, loop=self.loop))
+        self.assertEqual(listener.open_connections, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,10 +7,14 @@ This module implements the main bridging functionality.
 :copyright: (c) 2016 by saqura.
 :license: MIT, see LICENSE for more details.
 """
+import asyncio
+import functools
 import json
 import logging
 import os
+import socket
 import ssl
+import stat
 import aiohttp
 import aiohttp.web
 
@@ -31,6 +35,8 @@ class XMPPWebhookBridge:
         self.mucs = dict()
         # Mapping of MUC-JID -> Password
         self.muc_passwords = dict()
+        # Mapping of incoming webhook URL path -> List of bridges
+        self.incoming_webhook_routes = dict()
 
         try:
             # Get the optional XMPP address (host, port) if specified
@@ -51,6 +57,9 @@ class XMPPWebhookBridge:
             self.bridges.append(bridge)
             if bridge.has_incoming_webhooks():
                 need_incoming_webhooks = True
+            for path in bridge.get_incoming_webhook_paths():
+                self.incoming_webhook_routes.setdefault(path, list()).append(
+                    bridge)
 
         # Initialize XMPP client
         self.xmpp_client = XMPPBridgeBot(cfg['xmpp']['jid'],
@@ -59,33 +68,51 @@ class XMPPWebhookBridge:
         self.xmpp_client.connect(address=xmpp_address)
 
         # Initialize HTTP server if needed
+        self.http_listeners = list()
         if not need_incoming_webhooks:
-            self.http_server = None
             logging.info("No incoming webhooks defined.")
         elif 'incoming_webhook_listener' in cfg:
-            bind_address = cfg['incoming_webhook_listener']['bind_address']
-            port = cfg['incoming_webhook_listener']['port']
+            self.get_http_listeners(cfg)
             self.http_app = aiohttp.web.Application(loop=loop)
-            self.http_app.router.add_route('POST',
-                                           '/',
-                                           self.handle_incoming_webhook)
-            self.http_handler = self.http_app.make_handler()
-            http_create_server = loop.create_server(
-                self.http_handler,
-                bind_address,
-                port)
-            self.http_server = loop.run_until_complete(http_create_server)
-            logging.info("Listening for incoming webhooks on "
-                         "http://{}:{}/".format(bind_address, port))
+            for path in self.incoming_webhook_routes:
+                # Each path gets its own handler, so that the router decides
+                # which bridges are responsible for a request.
+                self.http_app.router.add_route(
+                    'POST',
+                    path,
+                    functools.partial(self.handle_incoming_webhook, path))
+            self.start_http_listeners()
         else:
-            self.http_server = None
             logging.warn("No 'incoming_webhook_listener' in the config even "
                          "though incoming webhooks are defined. Ignoring all "
                          "incoming webhooks.")
 
-        if not self.http_server:
+        if not self.http_listeners:
             logging.info("Not listening for incoming webhooks.")
 
+    def start_http_listeners(self):
+        """Starts all listeners for incoming webhooks. If one of them cannot
+        be started, the listeners that were already started are stopped
+        again.
+        """
+        for listener in self.http_listeners:
+            try:
+                listener.start(self.http_app, self.loop)
+            except OSError as e:
+                for started_listener in self.http_listeners:
+                    started_listener.stop_accepting(self.loop)
+                raise InvalidConfigError("Could not listen for incoming "
+                                         "webhooks on {}: {}".format(listener,
+                                                                     e))
+
+    async def drain_http_listeners(self):
+        """This coroutine drains the connections of all listeners at the same
+        time, so that shutting down takes at most the longest
+        `shutdown_timeout`.
+        """
+        await asyncio.gather(*[listener.drain_connections()
+                               for listener in self.http_listeners])
+
     def process(self):
         self.loop.run_forever()
 
@@ -144,9 +171,9 @@ class XMPPWebhookBridge:
         await request.release()
         return
 
-    async def handle_incoming_webhook(self, request):
+    async def handle_incoming_webhook(self, path, request):
         """This coroutine handles incoming webhooks: It receives incoming
-        webhooks and relays the messages to XMPP."""
+        webhooks on the given URL path and relays the messages to XMPP."""
         if request.content_type == 'application/json':
             payload = await request.json()
             # print(payload)
@@ -159,16 +186,36 @@ class XMPPWebhookBridge:
             return aiohttp.web.Response()
 
         token = payload['token']
-        logging.debug("--> Handling incoming request from token "
-                      "'{}'...".format(token))
+        logging.debug("--> Handling incoming request on '{}' from token "
+                      "'{}'...".format(path, token))
         username = payload['user_name']
         msg = payload['text']
 
-        for bridge in self.bridges:
+        # Only the bridges with incoming webhooks on this URL path are
+        # considered.
+        for bridge in self.incoming_webhook_routes[path]:
             bridge.handle_incoming_webhook(token, username, msg)
 
         return aiohttp.web.Response()
 
+    def get_http_listeners(self, cfg):
+        """Reads the listener definitions from the config file."""
+        listener_cfgs = cfg['incoming_webhook_listener']
+        if isinstance(listener_cfgs, dict):
+            # A single listener may be given without wrapping it in a list.
+            listener_cfgs = [listener_cfgs]
+        if not isinstance(listener_cfgs, list):
+            raise InvalidConfigError("Error in config file: "
+                                     "'incoming_webhook_listener' must be a "
+                                     "listener or a list of listeners.")
+
+        for listener_cfg in listener_cfgs:
+            if not isinstance(listener_cfg, dict):
+                raise InvalidConfigError("Error in config file: "
+                                         "'incoming_webhook_listener' "
+                                         "contains an invalid entry.")
+            self.http_listeners.append(WebhookListener(listener_cfg))
+
     def get_mucs(self, cfg):
         """Reads the MUC definitions from the config file."""
         if 'mucs' not in cfg['xmpp']:
@@ -208,12 +255,13 @@ class XMPPWebhookBridge:
         """Closes all open connections, servers and handlers. This is used
         when exiting the bridge.
         """
-        if self.http_server:
+        if self.http_listeners:
             logging.info("Closing HTTP server...")
-            self.http_server.close()
-            self.loop.run_until_complete(self.http_server.wait_closed())
-            self.loop.run_until_complete(self.http_handler.
-                                         finish_connections(1.0))
+            # Stop accepting new connections on all listeners first, then
+            # give the open connections a chance to finish their requests.
+            for listener in self.http_listeners:
+                listener.stop_accepting(self.loop)
+            self.loop.run_until_complete(self.drain_http_listeners())
             self.loop.run_until_complete(self.http_app.finish())
             logging.info("Closed HTTP server..")
 
@@ -232,6 +280,178 @@ class InvalidConfigError(Exception):
     pass
 
 
+class WebhookListener:
+    def __init__(self, listener_cfg):
+        """Parses a listener entry of the `incoming_webhook_listener` section
+        of the config file. A listener either binds to a TCP address and port
+        or to a Unix domain socket.
+        """
+        self.http_server = None
+        self.http_handler = None
+        # Number of connections that are currently open.
+        self.open_connections = 0
+
+        self.socket_path = None
+        self.socket_mode = None
+        self.bind_address = None
+        self.port = None
+
+        if 'socket_path' in listener_cfg:
+            self.socket_path = os.path.abspath(listener_cfg['socket_path'])
+            if 'mode' in listener_cfg:
+                self.socket_mode = self._parse_socket_mode(
+                    listener_cfg['mode'])
+        elif 'bind_address' in listener_cfg and 'port' in listener_cfg:
+            self.bind_address = listener_cfg['bind_address']
+            self.port = listener_cfg['port']
+        else:
+            raise InvalidConfigError("Error in config file: "
+                                     "'incoming_webhook_listener' must "
+                                     "contain either 'bind_address' and "
+                                     "'port' or 'socket_path'.")
+
+        # Maximum number of pending connections that are not yet accepted.
+        self.backlog = listener_cfg.get('backlog', 100)
+        # Maximum number of connections that are open at the same time.
+        # Unlimited if None.
+        self.max_connections = listener_cfg.get('max_connections', None)
+        # Seconds an idle HTTP/1.1 connection is kept open for further
+        # requests.
+        self.keep_alive_timeout = listener_cfg.get('keep_alive_timeout', 75)
+        # Seconds open connections may take to finish on shutdown.
+        self.shutdown_timeout = listener_cfg.get('shutdown_timeout', 1.0)
+
+    def __str__(self):
+        if self.socket_path:
+            return "unix:{}".format(self.socket_path)
+        return "http://{}:{}/".format(self.bind_address, self.port)
+
+    def start(self, http_app, loop):
+        """Starts listening for incoming webhooks that are handled by the
+        given HTTP application.
+        """
+        self.http_handler = http_app.make_handler(
+            keep_alive=self.keep_alive_timeout)
+        if self.socket_path:
+            http_create_server = loop.create_unix_server(
+                self.create_protocol,
+                sock=self._bind_unix_socket(),
+                backlog=self.backlog)
+        else:
+            http_create_server = loop.create_server(
+                self.create_protocol,
+                self.bind_address,
+                self.port,
+                backlog=self.backlog)
+        self.http_server = loop.run_until_complete(http_create_server)
+        logging.info("Listening for incoming webhooks on {}".format(self))
+
+    def create_protocol(self):
+        """Creates the protocol for a new connection. Connections exceeding
+        `max_connections` are closed right away.
+
+        The open connections are counted here rather than taken from the
+        HTTP handler, because the handler only registers a connection in
+        `connection_made`, which runs after all connections accepted at the
+        same time have been created.
+        """
+        if (self.max_connections is not None and
+                self.open_connections >= self.max_connections):
+            logging.warning("Too many connections on {}. Closing new "
+                            "connection.".format(self))
+            return RejectedConnectionProtocol()
+
+        protocol = self.http_handler()
+        handler_connection_lost = protocol.connection_lost
+
+        def connection_lost(exc):
+            self.open_connections -= 1
+            handler_connection_lost(exc)
+
+        protocol.connection_lost = connection_lost
+        self.open_connections += 1
+        return protocol
+
+    def stop_accepting(self, loop):
+        """Closes the listening socket so that no new connections are
+        accepted. Already open connections are kept.
+        """
+        if self.http_server is None:
+            # This listener was never started.
+            return
+        self.http_server.close()
+        loop.run_until_complete(self.http_server.wait_closed())
+        if self.socket_path and os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def drain_connections(self):
+        """Returns a coroutine that waits for the open connections to finish
+        their requests and closes them, or closes them forcibly once the
+        shutdown timeout is over.
+        """
+        return self.http_handler.finish_connections(self.shutdown_timeout)
+
+    def _bind_unix_socket(self):
+        """Creates the Unix domain socket of this listener and binds it to
+        its path. A stale socket left over from a previous run is removed.
+        """
+        try:
+            if stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if self.socket_mode is None:
+                sock.bind(self.socket_path)
+            else:
+                # The umask makes bind() create the socket file without any
+                # permissions beyond the requested mode, so it is never
+                # accessible with looser permissions. As the umask applies
+                # to the whole process, it is only changed for the bind()
+                # call itself, during which no other code runs. Not every
+                # platform creates socket files with exactly the permissions
+                # the umask leaves, so chmod() afterwards sets the exact mode.
+                old_umask = os.umask(~self.socket_mode & 0o777)
+                try:
+                    sock.bind(self.socket_path)
+                finally:
+                    os.umask(old_umask)
+                os.chmod(self.socket_path, self.socket_mode)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _parse_socket_mode(self, mode):
+        """Parses the permissions of the Unix domain socket, given either as
+        an octal string or as an integer.
+        """
+        if isinstance(mode, str):
+            try:
+                mode = int(mode, 8)
+            except ValueError:
+                mode = None
+        elif isinstance(mode, bool) or not isinstance(mode, int):
+            mode = None
+
+        if mode is None or not 0 <= mode <= 0o777:
+            raise InvalidConfigError("Error in config file: 'mode' of an "
+                                     "incoming webhook listener must be an "
+                                     "octal string between \"0000\" and "
+                                     "\"0777\", such as \"0660\".")
+        return mode
+
+
+class RejectedConnectionProtocol(asyncio.Protocol):
+    """Protocol for connections over the `max_connections` limit of a
+    :class:`WebhookListener`. It closes the connection immediately.
+    """
+    def connection_made(self, transport):
+        transport.close()
+
+
 class SingleBridge:
     def __init__(self, bridge_cfg, main_bridge):
         """Parses a bridge section of the config file and creates a new
@@ -254,6 +474,11 @@ class SingleBridge:
         """Returns True if this bridge contains incoming webhooks."""
         return (len(self.incoming_webhooks) != 0)
 
+    def get_incoming_webhook_paths(self):
+        """Returns the set of URL paths of this bridge's incoming webhooks."""
+        return {incoming_webhook['path']
+                for incoming_webhook in self.incoming_webhooks}
+
     def handle_incoming_webhook(self, token, username, msg):
         """Handles an incoming webhook with the given token, username
         and message.
@@ -351,6 +576,21 @@ class SingleBridge:
                                          "webhook definition.")
             if 'ignore_user' not in incoming_webhook:
                 incoming_webhook['ignore_user'] = list()
+            if 'path' not in incoming_webhook:
+                incoming_webhook['path'] = '/'
+            elif not isinstance(incoming_webhook['path'], str):
+                raise InvalidConfigError("Error in config file: "
+                                         "'path' of an incoming webhook "
+                                         "must be a string.")
+            elif not incoming_webhook['path'].startswith('/'):
+                raise InvalidConfigError("Error in config file: "
+                                         "'path' of an incoming webhook "
+                                         "must start with '/'.")
+            elif ('{' in incoming_webhook['path'] or
+                    '}' in incoming_webhook['path']):
+                raise InvalidConfigError("Error in config file: "
+                                         "'path' of an incoming webhook "
+                                         "must not contain '{' or '}'.")
             self.incoming_webhooks.append(incoming_webhook)
 
     def _parse_outgoing_webhooks(self, bridge_cfg):